@@ -6,11 +6,21 @@ from completionist.commands.complete import complete_cmd
 
 # from completionist.commands.compose import compose_cmd
 from completionist.commands.translate import translate_cmd
+from completionist.llm_api import close_http_client
+from completionist.utils import set_debug
 
 
 @click.group()
-def entry_point():
-    pass
+@click.option(
+    "--debug",
+    is_flag=True,
+    help="Print full tracebacks when a request or sample fails.",
+)
+@click.pass_context
+def entry_point(ctx, debug):
+    set_debug(debug)
+    # Release pooled keep-alive connections once the command has finished.
+    ctx.call_on_close(close_http_client)
 
 
 entry_point.add_command(build_cmd)
@@ -2,15 +2,21 @@ import os
 import sys
 import click
 import importlib
-import traceback
 
 from pydantic import BaseModel
 from huggingface_hub import get_token
+from tqdm import tqdm
 
 from completionist.processing import process_samples_with_executor
-from completionist.dataset_io import save_and_push_dataset
-from completionist.utils import read_file_content
-from completionist.llm_api import get_completion
+from completionist.dataset_io import (
+    arrow_schema_for_model,
+    get_checkpoint_file,
+    load_topics,
+    prepare_topic_tasks,
+    write_output,
+)
+from completionist.utils import describe_exception, read_file_content
+from completionist.llm_api import get_completion, get_batch_completions
 
 
 def load_schema_from_import_path(import_path: str) -> BaseModel:
@@ -34,10 +40,8 @@ def build_task_handler(topic: str, llm_config: dict):
     """
     Task handler for generating a single structured data sample for a given topic.
     """
-    user_prompt_template = llm_config["user_prompt_template"]
-
     try:
-        user_prompt = user_prompt_template.format(topic=topic)
+        user_prompt = llm_config["user_prompts"][topic]
 
         # Call the centralized get_completion function with the schema
         result = get_completion(
@@ -50,15 +54,17 @@ def build_task_handler(topic: str, llm_config: dict):
             pydantic_schema=llm_config["pydantic_schema"],
             temperature=llm_config["generation_config"]["temperature"],
             top_p=llm_config["generation_config"]["top_p"],
+            stream_validate=llm_config["stream_validate"],
+            max_rps=llm_config["max_rps"],
         )
 
         if result:
             return result.model_dump()
         return None
 
-    except Exception:
-        print(
-            f"\nWarning: Failed to generate a valid sample for topic '{topic}'. Reason: {traceback.format_exc()}"
+    except Exception as e:
+        tqdm.write(
+            f"Warning: Failed to generate a valid sample for topic '{topic}'. Reason: {describe_exception(e)}"
         )
         return None
 
@@ -105,7 +111,8 @@ def build_task_handler(topic: str, llm_config: dict):
 @click.option(
     "--api-url",
     default="http://localhost:11434/v1",
-    help="(Optional) The API endpoint URL for the LLM. Defaults to Ollama's base URL.",
+    help="(Optional) The API endpoint URL for the LLM. Defaults to Ollama's base URL. "
+    "Pass several comma-separated URLs to load-balance across replicas.",
 )
 @click.option(
     "--workers",
@@ -113,6 +120,20 @@ def build_task_handler(topic: str, llm_config: dict):
     default=4,
     help="(Optional) Number of concurrent requests to make to the API. Defaults to 4.",
 )
+@click.option(
+    "--max-workers",
+    type=int,
+    default=None,
+    help="(Optional) Let concurrency adapt between --workers and this value based "
+    "on observed request latency. Disabled by default.",
+)
+@click.option(
+    "--max-rps",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="(Optional) Maximum requests per second sent to each API endpoint, "
+    "shared across all workers. Unlimited by default.",
+)
 @click.option(
     "--push-to-hub",
     is_flag=True,
@@ -132,6 +153,19 @@ def build_task_handler(topic: str, llm_config: dict):
 @click.option(
     "--top-p", type=float, default=0.95, help="Nucleus sampling (top-p) for generation."
 )
+@click.option(
+    "--use-batch-api",
+    is_flag=True,
+    help="(Optional) Submit all samples as a single Batch API job instead of real-time requests. "
+    "Cheaper and higher throughput on endpoints that support /v1/batches, but results "
+    "arrive only when the whole batch completes.",
+)
+@click.option(
+    "--stream-validate",
+    is_flag=True,
+    help="(Optional) Stream each response and abort it as soon as the JSON output becomes "
+    "structurally invalid, saving the tokens of samples that would fail validation anyway.",
+)
 def build_cmd(
     schema,
     topics_file,
@@ -142,10 +176,14 @@ def build_cmd(
     model_name,
     api_url,
     workers,
+    max_workers,
+    max_rps,
     push_to_hub,
     hf_repo_id,
     temperature,
     top_p,
+    use_batch_api,
+    stream_validate,
 ):
     """
     Generate a structured dataset from a list of topics using a Pydantic schema.
@@ -159,17 +197,10 @@ def build_cmd(
 
     # Load all external assets
     pydantic_schema = load_schema_from_import_path(schema)
-    topics = [
-        line for line in read_file_content(topics_file).splitlines() if line.strip()
-    ]
+    topics = load_topics(topics_file)
     system_prompt = read_file_content(system_prompt_file)
     user_prompt_template = read_file_content(user_prompt_template_file)
 
-    if not topics:
-        print(
-            f"Error: Topics file '{topics_file}' is empty or contains no valid lines."
-        )
-        sys.exit(1)
     if "{topic}" not in user_prompt_template:
         print(
             "Error: The user prompt template must contain a '{topic}' placeholder.\n"
@@ -184,33 +215,69 @@ def build_cmd(
         "api_url": api_url,
         "pydantic_schema": pydantic_schema,
         "system_prompt": system_prompt,
-        "user_prompt_template": user_prompt_template,
+        # Each topic is sampled num_samples times, so its prompt is rendered once.
+        "user_prompts": {
+            topic: user_prompt_template.format(topic=topic) for topic in topics
+        },
         "generation_config": {"temperature": temperature, "top_p": top_p},
         "hf_api_token": hf_api_token,
         "openai_api_token": openai_api_token,
+        "max_rps": max_rps,
+        "stream_validate": stream_validate,
     }
 
-    # Create a list of all tasks to run (num_samples for each topic)
-    tasks_to_run = []
-    for topic in topics:
-        tasks_to_run.extend([topic] * num_samples)
+    # num_samples tasks per topic, minus those an earlier run already wrote.
+    tasks_to_run, resume_idx, existing_rows = prepare_topic_tasks(
+        topics, num_samples, output_file, "samples"
+    )
 
     total_tasks = len(tasks_to_run)
-    print(
-        f"Starting structured data generation for {total_tasks} samples ({num_samples} per topic) with {workers} workers..."
-    )
 
-    generated_samples = process_samples_with_executor(
-        dataset_to_process=tasks_to_run,
-        workers=workers,
-        resume_idx=0,  # No resume functionality for build command
-        task_handler=build_task_handler,
-        llm_config=llm_config,
-    )
+    def generate(sink):
+        if use_batch_api:
+            print(
+                f"Submitting structured data generation for {total_tasks} samples ({num_samples} per topic) to the Batch API..."
+            )
+            try:
+                results = get_batch_completions(
+                    prompts=[
+                        llm_config["user_prompts"][topic] for topic in tasks_to_run
+                    ],
+                    model_name=model_name,
+                    api_url=api_url,
+                    pydantic_schema=pydantic_schema,
+                    system_prompt=system_prompt,
+                    hf_api_token=hf_api_token,
+                    openai_api_token=openai_api_token,
+                    temperature=temperature,
+                    top_p=top_p,
+                )
+            except Exception as e:
+                print(f"Error: Batch generation failed: {e}")
+                sys.exit(1)
+            rows = [result.model_dump() for result in results if result]
+            sink.extend(rows)
+            return len(rows)
+        else:
+            print(
+                f"Starting structured data generation for {total_tasks} samples ({num_samples} per topic) with {workers} workers..."
+            )
+            return process_samples_with_executor(
+                dataset_to_process=tasks_to_run,
+                workers=workers,
+                max_workers=max_workers,
+                resume_idx=resume_idx,
+                task_handler=build_task_handler,
+                llm_config=llm_config,
+                sink=sink,
+                checkpoint_file=get_checkpoint_file(output_file),
+            )
 
-    save_and_push_dataset(
-        completions=generated_samples,
-        output_file=output_file,
+    write_output(
+        output_file,
+        existing_rows,
+        generate,
+        schema=arrow_schema_for_model(pydantic_schema),
         push_to_hub=push_to_hub,
         hf_repo_id=hf_repo_id,
         hf_api_token=hf_api_token,
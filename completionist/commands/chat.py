@@ -1,15 +1,21 @@
 import os
 import sys
 import random
-import traceback
 
 import click
 from pydantic import BaseModel, Field
 from huggingface_hub import get_token
+from tqdm import tqdm
 
 from completionist.processing import process_samples_with_executor
-from completionist.dataset_io import save_and_push_dataset
-from completionist.utils import read_file_content
+from completionist.dataset_io import (
+    arrow_schema_for_model,
+    get_checkpoint_file,
+    load_topics,
+    prepare_topic_tasks,
+    write_output,
+)
+from completionist.utils import describe_exception, read_file_content
 from completionist.llm_api import get_completion
 
 
@@ -70,22 +76,17 @@ def chat_task_handler(topic: str, llm_config: dict):
             top_p=llm_config["generation_config"]["top_p"],
             max_tokens=llm_config.get("max_tokens", 2048),
             reasoning=llm_config.get("reasoning"),
+            max_rps=llm_config["max_rps"],
         )
 
         if result is None:
             return None
-        if isinstance(result, ChatConversation):
-            return result.model_dump()
-        # outlines returned a raw string — attempt JSON parse as fallback
-        import json
-
-        raw = json.loads(result)
-        return ChatConversation(**raw).model_dump()
-
-    except Exception:
-        print(
-            f"\nWarning: Failed to generate conversation for topic '{topic}'. "
-            f"Reason: {traceback.format_exc()}"
+        return result.model_dump()
+
+    except Exception as e:
+        tqdm.write(
+            f"Warning: Failed to generate conversation for topic '{topic}'. "
+            f"Reason: {describe_exception(e)}"
         )
         return None
 
@@ -131,7 +132,8 @@ def chat_task_handler(topic: str, llm_config: dict):
 @click.option(
     "--api-url",
     default="http://localhost:11434/v1",
-    help="(Optional) The API endpoint URL for the LLM. Defaults to Ollama's base URL.",
+    help="(Optional) The API endpoint URL for the LLM. Defaults to Ollama's base URL. "
+    "Pass several comma-separated URLs to load-balance across replicas.",
 )
 @click.option(
     "--system-prompt",
@@ -157,6 +159,20 @@ def chat_task_handler(topic: str, llm_config: dict):
     default=4,
     help="(Optional) Number of concurrent requests. Defaults to 4.",
 )
+@click.option(
+    "--max-workers",
+    type=int,
+    default=None,
+    help="(Optional) Let concurrency adapt between --workers and this value based "
+    "on observed request latency. Disabled by default.",
+)
+@click.option(
+    "--max-rps",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="(Optional) Maximum requests per second sent to each API endpoint, "
+    "shared across all workers. Unlimited by default.",
+)
 @click.option(
     "--push-to-hub",
     is_flag=True,
@@ -201,6 +217,8 @@ def chat_cmd(
     system_prompt_file,
     user_prompt_template,
     workers,
+    max_workers,
+    max_rps,
     push_to_hub,
     hf_repo_id,
     temperature,
@@ -232,15 +250,7 @@ def chat_cmd(
     if not user_prompt_template_content:
         user_prompt_template_content = DEFAULT_USER_PROMPT_TEMPLATE
 
-    # Load topics
-    topics = [
-        line for line in read_file_content(topics_file).splitlines() if line.strip()
-    ]
-    if not topics:
-        print(
-            f"Error: Topics file '{topics_file}' is empty or contains no valid lines."
-        )
-        sys.exit(1)
+    topics = load_topics(topics_file)
 
     # Prepare configuration
     llm_config = {
@@ -253,31 +263,36 @@ def chat_cmd(
         "generation_config": {"temperature": temperature, "top_p": top_p},
         "hf_api_token": hf_api_token,
         "openai_api_token": openai_api_token,
+        "max_rps": max_rps,
         "reasoning": reasoning,
         "max_tokens": max_tokens,
     }
 
-    # Build task list: num_conversations per topic
-    tasks = []
-    for topic in topics:
-        tasks.extend([topic] * num_conversations)
+    # num_conversations tasks per topic, minus those an earlier run already
+    # wrote.
+    tasks, resume_idx, existing_rows = prepare_topic_tasks(
+        topics, num_conversations, output_file, "conversations"
+    )
 
     print(
         f"Generating {len(tasks)} conversations ({num_conversations} per topic) "
         f"across {len(topics)} topics with {workers} workers..."
     )
 
-    generated = process_samples_with_executor(
-        dataset_to_process=tasks,
-        workers=workers,
-        resume_idx=0,
-        task_handler=chat_task_handler,
-        llm_config=llm_config,
-    )
-
-    save_and_push_dataset(
-        completions=generated,
-        output_file=output_file,
+    write_output(
+        output_file,
+        existing_rows,
+        lambda sink: process_samples_with_executor(
+            dataset_to_process=tasks,
+            workers=workers,
+            max_workers=max_workers,
+            resume_idx=resume_idx,
+            task_handler=chat_task_handler,
+            llm_config=llm_config,
+            sink=sink,
+            checkpoint_file=get_checkpoint_file(output_file),
+        ),
+        schema=arrow_schema_for_model(ChatConversation),
         push_to_hub=push_to_hub,
         hf_repo_id=hf_repo_id,
         hf_api_token=hf_api_token,
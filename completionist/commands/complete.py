@@ -1,32 +1,56 @@
 import os
+import re
+import string
 import click
+from datasets import Dataset
 from huggingface_hub import get_token
 
 from completionist.processing import process_samples_with_executor
-from completionist.dataset_io import load_and_prepare_dataset, save_and_push_dataset
-from completionist.llm_api import get_completion
+from completionist.dataset_io import (
+    get_checkpoint_file,
+    load_and_prepare_dataset,
+    string_schema,
+    write_output,
+)
+from completionist.llm_api import get_completion, get_text_completions
 from completionist.utils import read_file_content, handle_error
 
 
-def complete_task_handler(sample, llm_config):
-    """
-    Helper function to generate a completion for a single sample for the 'complete' command.
-    """
-    prompt = ""
-    prompt_template = llm_config.get("prompt_template")
+def _template_fields(prompt_template):
+    """Returns the column names referenced by {placeholders} in a prompt template."""
+    fields = set()
+    for _, field, _, _ in string.Formatter().parse(prompt_template):
+        if field is not None:
+            fields.add(re.split(r"[.\[]", field, maxsplit=1)[0])
+    return fields
 
-    if prompt_template:
-        try:
-            prompt = prompt_template.format(**sample)
-        except KeyError as e:
-            print(
-                f"\nError: The placeholder {{{e.args[0]}}} in your prompt template was not found "
-                f"as a column in the dataset. Available columns: {list(sample.keys())}"
-            )
-            return None
-    else:
-        prompt = sample[llm_config["prompt_input_field"]]
 
+def _render_prompts(batch, prompt_template):
+    """Formats the prompt template for a batch of rows (used with Dataset.map)."""
+    num_rows = len(next(iter(batch.values())))
+    return {
+        "_rendered_prompt": [
+            prompt_template.format(**{k: v[i] for k, v in batch.items()})
+            for i in range(num_rows)
+        ]
+    }
+
+
+def _completion_row(prompt, completion, llm_config):
+    """Builds the output row for a completion, or returns None if it failed."""
+    if not completion:
+        return None
+    return {
+        llm_config["prompt_output_field"]: prompt,
+        llm_config["completion_output_field"]: completion["content"],
+        "reasoning": completion["reasoning_content"] or "",
+    }
+
+
+def complete_task_handler(prompt: str, llm_config: dict):
+    """
+    Helper function to generate a completion for a single prompt for the 'complete' command.
+    """
     completion = get_completion(
         prompt=prompt,
         model_name=llm_config["model_name"],
@@ -37,15 +61,33 @@ def complete_task_handler(sample, llm_config):
         max_tokens=llm_config["max_tokens"],
         temperature=llm_config["temperature"],
         top_p=llm_config["top_p"],
+        max_rps=llm_config["max_rps"],
+        max_reasoning_tokens=llm_config["max_reasoning_tokens"],
+        memoize=llm_config["dedupe_prompts"],
     )
+    return _completion_row(prompt, completion, llm_config)
+
 
-    if completion:
-        return {
-            llm_config["prompt_output_field"]: prompt,
-            llm_config["completion_output_field"]: completion["content"],
-            "reasoning": completion["reasoning_content"] or "",
-        }
-    return None
+def complete_batch_task_handler(prompts: list, llm_config: dict):
+    """
+    Generates completions for a list of prompts with a single request to the
+    completions endpoint (--batch-size). Returns one row (or None) per prompt.
+    """
+    completions = get_text_completions(
+        prompts=prompts,
+        model_name=llm_config["model_name"],
+        api_url=llm_config["api_url"],
+        hf_api_token=llm_config["hf_api_token"],
+        openai_api_token=llm_config["openai_api_token"],
+        max_tokens=llm_config["max_tokens"],
+        temperature=llm_config["temperature"],
+        top_p=llm_config["top_p"],
+        max_rps=llm_config["max_rps"],
+    )
+    return [
+        _completion_row(prompt, completion, llm_config)
+        for prompt, completion in zip(prompts, completions)
+    ]
 
 
 @click.command()
@@ -63,7 +105,8 @@ def complete_task_handler(sample, llm_config):
 @click.option(
     "--api-url",
     default="http://localhost:11434/v1",
-    help="(Optional) The API endpoint URL for the LLM. Defaults to Ollama's OpenAI-compatible endpoint.",
+    help="(Optional) The API endpoint URL for the LLM. Defaults to Ollama's OpenAI-compatible endpoint. "
+    "Pass several comma-separated URLs to load-balance across replicas.",
 )
 @click.option(
     "--system-prompt",
@@ -88,6 +131,14 @@ def complete_task_handler(sample, llm_config):
     default=2048,
     help="(Optional) The maximum number of tokens to generate per completion.",
 )
+@click.option(
+    "--max-reasoning-tokens",
+    type=int,
+    default=None,
+    help="(Optional) Stream each response and abort it once the model has spent this "
+    "many tokens reasoning (<think> blocks or reasoning_content) without answering; "
+    "the sample is skipped.",
+)
 @click.option(
     "--limit",
     type=int,
@@ -97,6 +148,12 @@ def complete_task_handler(sample, llm_config):
 @click.option(
     "--shuffle", is_flag=True, help="(Optional) Shuffle the dataset before processing."
 )
+@click.option(
+    "--streaming",
+    is_flag=True,
+    help="(Optional) Stream the dataset instead of downloading it in full first. "
+    "Useful with --limit on large datasets; --shuffle then uses a 10k-row buffer.",
+)
 @click.option(
     "--push-to-hub",
     is_flag=True,
@@ -113,6 +170,35 @@ def complete_task_handler(sample, llm_config):
     default=4,
     help="(Optional) Number of concurrent requests to make to the API. Defaults to 4.",
 )
+@click.option(
+    "--max-workers",
+    type=int,
+    default=None,
+    help="(Optional) Let concurrency adapt between --workers and this value based "
+    "on observed request latency. Disabled by default.",
+)
+@click.option(
+    "--max-rps",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="(Optional) Maximum requests per second sent to each API endpoint, "
+    "shared across all workers. Unlimited by default.",
+)
+@click.option(
+    "--dedupe-prompts",
+    is_flag=True,
+    help="(Optional) Generate one completion per distinct prompt and reuse it for "
+    "duplicate samples, even when sampling with temperature > 0. Completions "
+    "are reused from a bounded cache of the 4096 most recent distinct prompts.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=None,
+    help="(Optional) Send this many prompts per request to the non-chat /completions "
+    "endpoint instead of one chat request per sample. Useful with vLLM; the prompts "
+    "are sent without a chat template, so it cannot be used with a system prompt.",
+)
 @click.option(
     "--prompt-input-field",
     required=True,
@@ -146,11 +232,17 @@ def complete_cmd(
     system_prompt_file,
     prompt_template_file,
     max_tokens,
+    max_reasoning_tokens,
     limit,
     shuffle,
+    streaming,
     push_to_hub,
     hf_repo_id,
     workers,
+    max_workers,
+    max_rps,
+    batch_size,
+    dedupe_prompts,
     prompt_input_field,
     prompt_output_field,
     completion_output_field,
@@ -164,6 +256,18 @@ def complete_cmd(
         raise click.UsageError(
             "Error: --system-prompt and --system-prompt-file are mutually exclusive."
         )
+    if batch_size and (system_prompt or system_prompt_file):
+        raise click.UsageError(
+            "Error: --batch-size cannot be used with a system prompt."
+        )
+    if batch_size and dedupe_prompts:
+        raise click.UsageError(
+            "Error: --batch-size cannot be used with --dedupe-prompts."
+        )
+    if batch_size and max_reasoning_tokens:
+        raise click.UsageError(
+            "Error: --batch-size cannot be used with --max-reasoning-tokens."
+        )
 
     hf_api_token = get_token()
     openai_api_token = os.environ.get("OPENAI_API_TOKEN", None)
@@ -183,37 +287,91 @@ def complete_cmd(
             prompt_input_field=prompt_input_field,
             shuffle=shuffle,
             limit=limit,
+            streaming=streaming,
         )
     )
 
+    if prompt_template:
+        # Placeholders are checked once up front, then every prompt is
+        # rendered in bulk so workers only receive the final string.
+        columns = dataset_to_process.column_names
+        fields = _template_fields(prompt_template)
+        if columns is not None:
+            missing = sorted(fields - set(columns))
+            if missing:
+                handle_error(
+                    f"Error: The placeholder {{{missing[0]}}} in your prompt template was not found "
+                    f"as a column in the dataset. Available columns: {columns}"
+                )
+        # Only the referenced columns are decoded by the map, and they are
+        # dropped from its output. A template without placeholders still
+        # needs one column to know how many rows each batch has.
+        template_columns = sorted(fields) or (columns or [])[:1]
+        if template_columns:
+            dataset_to_process = dataset_to_process.select_columns(template_columns)
+        map_kwargs = {"remove_columns": template_columns or None}
+        if isinstance(dataset_to_process, Dataset):
+            map_kwargs["desc"] = "Rendering prompts"
+            # Spawning processes only pays off on larger datasets.
+            if len(dataset_to_process) >= 10_000:
+                map_kwargs["num_proc"] = min(workers, os.cpu_count() or 1)
+        dataset_to_process = dataset_to_process.map(
+            _render_prompts,
+            batched=True,
+            fn_kwargs={"prompt_template": prompt_template},
+            **map_kwargs,
+        )
+
+    # Workers only receive the prompt string, so the other columns are never
+    # decoded. With a template, the prompts were rendered above.
+    prompt_column = "_rendered_prompt" if prompt_template else prompt_input_field
+    dataset_to_process = dataset_to_process.select_columns([prompt_column])
+
     llm_config = {
         "model_name": model_name,
         "api_url": api_url,
         "system_prompt": system_prompt_content,
-        "prompt_template": prompt_template,
         "hf_api_token": hf_api_token,
         "openai_api_token": openai_api_token,
+        "max_rps": max_rps,
+        "max_reasoning_tokens": max_reasoning_tokens,
+        "dedupe_prompts": dedupe_prompts,
         "max_tokens": max_tokens,
         "temperature": temperature,
         "top_p": top_p,
-        "prompt_input_field": prompt_input_field,
         "prompt_output_field": prompt_output_field,
         "completion_output_field": completion_output_field,
     }
 
+    if total_samples_in_dataset is None:
+        samples_label = "all remaining samples"
+    else:
+        samples_label = f"{max(total_samples_in_dataset - resume_idx, 0)} samples (out of {total_samples_in_dataset})"
     print(
-        f"Starting completion generation for {len(dataset_to_process)} samples (out of {total_samples_in_dataset}) with {workers} workers..."
+        f"Starting completion generation for {samples_label} with {workers} workers..."
     )
 
-    new_completions = process_samples_with_executor(
-        dataset_to_process=dataset_to_process,
-        workers=workers,
-        resume_idx=resume_idx,
-        task_handler=complete_task_handler,
-        llm_config=llm_config,
+    write_output(
+        output_file,
+        existing_completions,
+        lambda sink: process_samples_with_executor(
+            dataset_to_process=dataset_to_process,
+            workers=workers,
+            max_workers=max_workers,
+            resume_idx=resume_idx,
+            task_handler=complete_batch_task_handler
+            if batch_size
+            else complete_task_handler,
+            llm_config=llm_config,
+            sink=sink,
+            checkpoint_file=get_checkpoint_file(output_file),
+            batch_size=batch_size,
+            column=prompt_column,
+        ),
+        schema=string_schema(
+            [prompt_output_field, completion_output_field, "reasoning"]
+        ),
+        push_to_hub=push_to_hub,
+        hf_repo_id=hf_repo_id,
+        hf_api_token=hf_api_token,
     )
-    if len(new_completions) > 0:
-        all_completions = existing_completions + new_completions
-        save_and_push_dataset(
-            all_completions, output_file, push_to_hub, hf_repo_id, hf_api_token
-        )
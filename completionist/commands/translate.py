@@ -4,7 +4,12 @@ import click
 from huggingface_hub import get_token
 
 from completionist.processing import process_samples_with_executor
-from completionist.dataset_io import load_and_prepare_dataset, save_and_push_dataset
+from completionist.dataset_io import (
+    get_checkpoint_file,
+    load_and_prepare_dataset,
+    string_schema,
+    write_output,
+)
 from completionist.llm_api import get_completion
 from completionist.utils import read_file_content, handle_error
 
@@ -51,6 +56,8 @@ def _translate_with_cache(source_text, llm_config, cache):
         max_tokens=llm_config.get("max_tokens", 2048),
         reasoning_effort=llm_config.get("reasoning_effort"),
         reasoning=llm_config.get("reasoning"),
+        max_rps=llm_config["max_rps"],
+        max_reasoning_tokens=llm_config["max_reasoning_tokens"],
     )
 
     if completion and cache:
@@ -122,7 +129,8 @@ def translate_task_handler(sample, llm_config):
 @click.option(
     "--api-url",
     default="http://localhost:11434/v1",
-    help="(Optional) The API endpoint URL for the LLM. Defaults to Ollama's OpenAI-compatible endpoint.",
+    help="(Optional) The API endpoint URL for the LLM. Defaults to Ollama's OpenAI-compatible endpoint. "
+    "Pass several comma-separated URLs to load-balance across replicas.",
 )
 @click.option(
     "--system-prompt",
@@ -145,6 +153,12 @@ def translate_task_handler(sample, llm_config):
 @click.option(
     "--shuffle", is_flag=True, help="(Optional) Shuffle the dataset before processing."
 )
+@click.option(
+    "--streaming",
+    is_flag=True,
+    help="(Optional) Stream the dataset instead of downloading it in full first. "
+    "Useful with --limit on large datasets; --shuffle then uses a 10k-row buffer.",
+)
 @click.option(
     "--push-to-hub",
     is_flag=True,
@@ -161,6 +175,20 @@ def translate_task_handler(sample, llm_config):
     default=4,
     help="(Optional) Number of concurrent requests to make to the API. Defaults to 4.",
 )
+@click.option(
+    "--max-workers",
+    type=int,
+    default=None,
+    help="(Optional) Let concurrency adapt between --workers and this value based "
+    "on observed request latency. Disabled by default.",
+)
+@click.option(
+    "--max-rps",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="(Optional) Maximum requests per second sent to each API endpoint, "
+    "shared across all workers. Unlimited by default.",
+)
 @click.option(
     "--temperature",
     type=float,
@@ -174,6 +202,14 @@ def translate_task_handler(sample, llm_config):
     help="Maximum tokens to generate (including reasoning). Increase for reasoning models.",
     show_default=True,
 )
+@click.option(
+    "--max-reasoning-tokens",
+    type=int,
+    default=None,
+    help="(Optional) Stream each response and abort it once the model has spent this "
+    "many tokens reasoning (<think> blocks or reasoning_content) without answering; "
+    "the sample is skipped.",
+)
 @click.option(
     "--top-p", type=float, default=0.95, help="Nucleus sampling (top-p) for generation."
 )
@@ -203,11 +239,15 @@ def translate_cmd(
     system_prompt_file,
     limit,
     shuffle,
+    streaming,
     push_to_hub,
     hf_repo_id,
     workers,
+    max_workers,
+    max_rps,
     temperature,
     max_tokens,
+    max_reasoning_tokens,
     top_p,
     reasoning_effort,
     cache_url,
@@ -245,9 +285,17 @@ def translate_cmd(
             prompt_input_field=primary_field,
             shuffle=shuffle,
             limit=limit,
+            streaming=streaming,
         )
     )
 
+    # Only the fields being translated are decoded for the workers.
+    columns = dataset_to_process.column_names
+    if columns is not None:
+        dataset_to_process = dataset_to_process.select_columns(
+            [field for field in input_fields if field in columns]
+        )
+
     cache = _get_cache_client(cache_url)
     if cache:
         print(f"Using translation cache: {cache_url}")
@@ -258,6 +306,8 @@ def translate_cmd(
         "system_prompt": system_prompt_content,
         "hf_api_token": hf_api_token,
         "openai_api_token": openai_api_token,
+        "max_rps": max_rps,
+        "max_reasoning_tokens": max_reasoning_tokens,
         "temperature": temperature,
         "max_tokens": max_tokens,
         "top_p": top_p,
@@ -270,30 +320,37 @@ def translate_cmd(
     }
 
     fields_label = ", ".join(input_fields)
+    if total_samples_in_dataset is None:
+        samples_label = "all remaining samples"
+    else:
+        samples_label = (
+            f"{max(total_samples_in_dataset - resume_idx, 0)} samples "
+            f"(out of {total_samples_in_dataset})"
+        )
     print(
         f"Translating fields [{fields_label}] from {source_lang} to {target_lang} "
-        f"for {len(dataset_to_process)} samples "
-        f"(out of {total_samples_in_dataset}) with {workers} workers..."
+        f"for {samples_label} with {workers} workers..."
     )
 
-    def _save_progress(completions):
-        save_and_push_dataset(
-            existing_translations + completions,
-            output_file,
-            push_to_hub,
-            hf_repo_id,
-            hf_api_token,
-        )
-
-    new_translations = process_samples_with_executor(
-        dataset_to_process=dataset_to_process,
-        workers=workers,
-        resume_idx=resume_idx,
-        task_handler=translate_task_handler,
-        llm_config=llm_config,
-        save_callback=_save_progress,
-        save_every=50,
+    write_output(
+        output_file,
+        existing_translations,
+        lambda sink: process_samples_with_executor(
+            dataset_to_process=dataset_to_process,
+            workers=workers,
+            max_workers=max_workers,
+            resume_idx=resume_idx,
+            task_handler=translate_task_handler,
+            llm_config=llm_config,
+            sink=sink,
+            checkpoint_file=get_checkpoint_file(output_file),
+        ),
+        schema=string_schema(
+            name
+            for field in input_fields
+            for name in (f"source_{field}", f"translated_{field}")
+        ),
+        push_to_hub=push_to_hub,
+        hf_repo_id=hf_repo_id,
+        hf_api_token=hf_api_token,
     )
-
-    if len(new_translations) > 0:
-        _save_progress(new_translations)
@@ -1,9 +1,197 @@
+import abc
+import functools
+import itertools
+import json
 import os
 import sys
-from datasets import load_dataset, Dataset
-from huggingface_hub import HfApi
 
-from completionist.utils import handle_error
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datasets import load_dataset, load_dataset_builder, Dataset
+from huggingface_hub import CommitOperationAdd, CommitOperationDelete, HfApi
+
+from completionist.utils import (
+    dumps_json,
+    handle_error,
+    loads_json,
+    read_file_content,
+)
+
+
+# Content-defined chunking (pyarrow >= 21) makes page boundaries depend on the
+# data rather than on offsets, so rows shared between two versions of an output
+# file produce identical pages that the Hub's Xet storage deduplicates. The
+# options match the ones `datasets` uses when it pushes Parquet shards.
+_PARQUET_CDC_OPTIONS = (
+    {"min_chunk_size": 256 * 1024, "max_chunk_size": 1024 * 1024, "norm_level": 0}
+    if int(pa.__version__.split(".")[0]) >= 21
+    else None
+)
+
+# Prompts and completions repeat a lot (shared system prompts, templates), so
+# dictionary encoding plus ZSTD keeps outputs small, which in turn speeds up
+# resume reads and Hub uploads. Level 3 is ZSTD's default speed/size tradeoff.
+_PARQUET_WRITE_OPTIONS = {
+    "compression": "zstd",
+    "compression_level": 3,
+    "use_dictionary": True,
+    "write_statistics": True,
+}
+
+
+def get_checkpoint_file(output_file):
+    """Returns the path of the JSONL side-file that checkpoints in-progress rows."""
+    return f"{output_file}.progress.jsonl"
+
+
+def _rfind_newline(f, end, block_size=64 * 1024):
+    """
+    Returns the offset of the last newline before offset end in the binary file
+    f, or -1 if there is none, reading backwards one block at a time.
+    """
+    while end > 0:
+        start = max(0, end - block_size)
+        f.seek(start)
+        pos = f.read(end - start).rfind(b"\n")
+        if pos != -1:
+            return start + pos
+        end = start
+    return -1
+
+
+def _checkpoint_end(f):
+    """
+    Returns the offset just past the last complete row of the binary
+    checkpoint file f. Only the tail is inspected: a trailing line without a
+    newline is torn, and so is a last line that does not parse.
+    """
+    end = _rfind_newline(f, f.seek(0, os.SEEK_END))
+    if end == -1:
+        return 0
+    start = _rfind_newline(f, end) + 1
+    f.seek(start)
+    try:
+        loads_json(f.read(end - start))
+    except json.JSONDecodeError:
+        return start
+    return end + 1
+
+
+def open_checkpoint(checkpoint_file):
+    """
+    Opens a checkpoint file for line-buffered appending. A torn last line left
+    by a crash is truncated first, so new rows never get glued onto it.
+    """
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, "rb+") as f:
+            end = _checkpoint_end(f)
+            if end < f.seek(0, os.SEEK_END):
+                f.truncate(end)
+    return open(checkpoint_file, "a", encoding="utf-8", buffering=1)
+
+
+def read_checkpoint(checkpoint_file):
+    """Yields the rows appended to a checkpoint file, stopping at a torn last line."""
+    with open(checkpoint_file, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield loads_json(line)
+            except json.JSONDecodeError:
+                break
+
+
+def _count_checkpoint_rows(checkpoint_file, block_size=1024 * 1024):
+    """
+    Counts the complete rows in a checkpoint file by counting newlines,
+    without decoding the rows themselves.
+    """
+    with open(checkpoint_file, "rb") as f:
+        remaining = _checkpoint_end(f)
+        f.seek(0)
+        count = 0
+        while remaining:
+            block = f.read(min(block_size, remaining))
+            count += block.count(b"\n")
+            remaining -= len(block)
+    return count
+
+
+def resume_from_checkpoint(output_file):
+    """
+    Returns the number of rows in the output's checkpoint file and a lazy
+    iterator over them; (0, empty iterator) when there is no checkpoint.
+    """
+    checkpoint_file = get_checkpoint_file(output_file)
+    if not os.path.exists(checkpoint_file):
+        return 0, iter(())
+    print(f"Resuming from checkpoint file: {checkpoint_file}")
+    # New rows are appended to the same file during this run, so only the
+    # rows present now count as existing.
+    checkpointed = _count_checkpoint_rows(checkpoint_file)
+    return checkpointed, itertools.islice(
+        read_checkpoint(checkpoint_file), checkpointed
+    )
+
+
+def resume_from_output(output_file):
+    """
+    Returns the number of rows written by earlier runs, in the output file and
+    in its checkpoint, and a lazy iterator over them. Existing rows are only
+    counted here (the Parquet footer holds the row count); they are streamed
+    back from disk when the output is rewritten, Parquet rows as Arrow record
+    batches so sink.extend() can copy them without decoding them into dicts.
+    """
+    existing_sources = []
+    count = 0
+    if os.path.exists(output_file):
+        print(f"Resuming from existing file: {output_file}")
+        try:
+            if output_file.endswith(".jsonl"):
+                count += _count_checkpoint_rows(output_file)
+                existing_sources.append(read_checkpoint(output_file))
+            else:
+                count += pq.ParquetFile(output_file).metadata.num_rows
+                existing_sources.append(iter_parquet_batches(output_file))
+        except Exception as e:
+            print(f"Could not load existing output file: {e}. Starting from scratch.")
+    checkpointed, checkpoint_rows = resume_from_checkpoint(output_file)
+    count += checkpointed
+    existing_sources.append(checkpoint_rows)
+    return count, itertools.chain.from_iterable(existing_sources)
+
+
+def load_topics(topics_file):
+    """Reads one topic per non-blank line of topics_file, exiting if there are none."""
+    topics = [
+        line for line in read_file_content(topics_file).splitlines() if line.strip()
+    ]
+    if not topics:
+        print(
+            f"Error: Topics file '{topics_file}' is empty or contains no valid lines."
+        )
+        sys.exit(1)
+    return topics
+
+
+def prepare_topic_tasks(topics, per_topic, output_file, label):
+    """
+    Builds the task list for topic-seeded commands (each topic repeated
+    per_topic times) and skips the tasks whose rows an earlier run already
+    wrote, to the output file or to its checkpoint. Returns the remaining
+    tasks, the number of skipped tasks and a lazy iterator over those rows.
+    """
+    tasks = [topic for topic in topics for _ in range(per_topic)]
+    resume_idx, existing_rows = resume_from_output(output_file)
+    if resume_idx:
+        print(f"Found {resume_idx} existing {label}. Resuming from task {resume_idx}.")
+    return tasks[resume_idx:], resume_idx, existing_rows
+
+
+def iter_parquet_batches(parquet_file):
+    """Yields the row groups of a Parquet file as Arrow record batches."""
+    parquet = pq.ParquetFile(parquet_file)
+    for i in range(parquet.num_row_groups):
+        yield from parquet.read_row_group(i).to_batches()
 
 
 def load_and_prepare_dataset(
@@ -13,26 +201,42 @@ def load_and_prepare_dataset(
     shuffle,
     limit,
     split="train",
+    streaming=False,
 ):
     """
     Loads, prepares, and handles resume logic for the dataset.
-    Returns the dataset to process, the resume index, and the total dataset size.
+    Returns the dataset to process, the resume index, the total dataset size,
+    and a lazy iterator over the rows already generated by a previous run.
+    Rows from an existing Parquet output come as Arrow record batches, so
+    sink.extend() can copy them without decoding them into dicts.
+
+    With streaming=True the dataset is read lazily as an IterableDataset
+    instead of being downloaded in full first. The total size then comes from
+    the dataset metadata and is None when the metadata does not record it.
     """
     try:
         if os.path.isfile(dataset_name):
             if dataset_name.endswith(".jsonl"):
-                dataset = load_dataset("json", data_files=dataset_name)
+                dataset = load_dataset(
+                    "json", data_files=dataset_name, streaming=streaming
+                )
             elif dataset_name.endswith(".txt"):
-                dataset = load_dataset("text", data_files=dataset_name)
+                dataset = load_dataset(
+                    "text", data_files=dataset_name, streaming=streaming
+                )
             else:
                 handle_error(
                     f"Error: Unsupported file format for '{dataset_name}'. Please use .jsonl or .txt."
                 )
         else:
-            dataset = load_dataset(dataset_name)
+            dataset = load_dataset(dataset_name, streaming=streaming)
 
+        # Streaming datasets may not know their features before the first row.
+        features = dataset[split].features if split in dataset else None
         if split not in dataset or (
-            prompt_input_field and prompt_input_field not in dataset[split].features
+            prompt_input_field
+            and features is not None
+            and prompt_input_field not in features
         ):
             handle_error(
                 f"Error: The dataset must have a '{split}' split and a '{prompt_input_field}' feature."
@@ -41,68 +245,373 @@ def load_and_prepare_dataset(
     except Exception as e:
         handle_error(f"Error loading dataset: {e}")
 
-    if shuffle:
-        dataset = dataset.shuffle(seed=42)
+    if streaming:
+        total_samples_in_dataset = _get_num_examples(dataset_name, split)
+        if shuffle:
+            dataset = dataset.shuffle(seed=42, buffer_size=10_000)
+        if limit:
+            dataset = dataset.take(limit)
+            if total_samples_in_dataset is None or limit < total_samples_in_dataset:
+                total_samples_in_dataset = limit
+    else:
+        if shuffle:
+            dataset = dataset.shuffle(seed=42)
+        if limit:
+            dataset = dataset.select(range(min(limit, len(dataset))))
+        total_samples_in_dataset = len(dataset)
 
-    if limit:
-        dataset = dataset.select(range(limit))
+    resume_idx, existing_completions = (
+        (0, iter(())) if shuffle else resume_from_output(output_file)
+    )
+    if resume_idx:
+        print(
+            f"Found {resume_idx} existing completions. Resuming from index {resume_idx}."
+        )
 
-    completions = []
-    resume_idx = 0
-    if os.path.exists(output_file) and not shuffle:
-        print(f"Resuming from existing file: {output_file}")
+    if streaming:
+        dataset_to_process = dataset.skip(resume_idx)
+    else:
+        # A contiguous range is sliced zero-copy (no indices mapping). An
+        # empty one must be spelled as an empty selection: select() rejects
+        # a start index equal to the dataset's length.
+        start = min(resume_idx, len(dataset))
+        dataset_to_process = dataset.select(
+            range(start, len(dataset)) if start < len(dataset) else []
+        )
+
+    return (
+        dataset_to_process,
+        resume_idx,
+        total_samples_in_dataset,
+        existing_completions,
+    )
+
+
+def _get_num_examples(dataset_name, split):
+    """Reads a split's size from the dataset metadata without loading any data."""
+    if os.path.isfile(dataset_name):
+        return None
+    try:
+        splits = load_dataset_builder(dataset_name).info.splits
+        return splits[split].num_examples if splits and split in splits else None
+    except Exception:
+        return None
+
+
+class _OutputSink(abc.ABC):
+    """
+    Base class for writers that stream rows into an output file.
+
+    Rows are written to a temporary file next to output_file and only moved
+    into place by close(), so rows may be streamed back from the file that is
+    being replaced (as resume does). Once the output file is written, its
+    checkpoint file is no longer needed and is removed.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.tmp_file = f"{output_file}.tmp"
+        self.count = 0
+
+    @abc.abstractmethod
+    def append(self, row):
+        """Appends one row (a dict)."""
+
+    def append_batch(self, batch):
+        for row in batch.to_pylist():
+            self.append(row)
+
+    def extend(self, rows):
+        """Appends rows, which may also be pyarrow RecordBatches of rows."""
+        for row in rows:
+            if isinstance(row, pa.RecordBatch):
+                self.append_batch(row)
+            else:
+                self.append(row)
+
+    @abc.abstractmethod
+    def _finish(self):
+        """Flushes and closes the temporary file."""
+
+    def close(self):
+        """Finishes writing and moves the file into place."""
         try:
-            existing_dataset = Dataset.from_parquet(output_file)
-            completions = existing_dataset.to_list()
-            resume_idx = len(completions)
-            print(
-                f"Found {len(completions)} existing completions. Resuming from index {resume_idx}."
-            )
+            self._finish()
+            os.replace(self.tmp_file, self.output_file)
+            print(f"Generated dataset saved locally to {self.output_file}")
         except Exception as e:
-            print(f"Could not load existing Parquet file: {e}. Starting from scratch.")
+            handle_error(f"Error saving dataset locally: {e}")
 
-    dataset_to_process = dataset.select(range(resume_idx, len(dataset)))
-    total_samples_in_dataset = len(dataset)
+        checkpoint_file = get_checkpoint_file(self.output_file)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
 
-    return dataset_to_process, resume_idx, total_samples_in_dataset, completions
+    def discard(self):
+        """Stops writing and leaves any existing output file untouched."""
+        self._finish()
+        os.remove(self.tmp_file)
 
 
-def save_and_push_dataset(
-    completions, output_file, push_to_hub, hf_repo_id, hf_api_token
-):
+def string_schema(names):
+    """Returns an Arrow schema of nullable string columns."""
+    return pa.schema([(name, pa.string()) for name in names])
+
+
+_JSON_SCHEMA_TYPES = {
+    "string": pa.string(),
+    "integer": pa.int64(),
+    "number": pa.float64(),
+    "boolean": pa.bool_(),
+}
+
+
+def _arrow_type(node, defs):
+    """Maps a JSON schema node to an Arrow type, or None if there is no direct one."""
+    if "$ref" in node:
+        return _arrow_type(defs[node["$ref"].rsplit("/", 1)[1]], defs)
+    if "anyOf" in node:
+        # Optional[X] is "X or null"; real unions have no single Arrow type.
+        options = [option for option in node["anyOf"] if option.get("type") != "null"]
+        return _arrow_type(options[0], defs) if len(options) == 1 else None
+    kind = node.get("type")
+    if kind == "array":
+        item_type = _arrow_type(node.get("items", {}), defs)
+        return pa.list_(item_type) if item_type is not None else None
+    if kind == "object":
+        fields = [
+            (name, _arrow_type(child, defs))
+            for name, child in node.get("properties", {}).items()
+        ]
+        if not fields or any(field_type is None for _, field_type in fields):
+            return None
+        return pa.struct(fields)
+    # Enums and formatted strings (dates, ...) dump to Python objects.
+    if "enum" in node or "format" in node:
+        return None
+    return _JSON_SCHEMA_TYPES.get(kind)
+
+
+def arrow_schema_for_model(model):
     """
-    Saves the generated completions locally and pushes them to the Hugging Face Hub if requested.
+    Returns the Arrow schema of model_dump() rows of a Pydantic model, or None
+    when a field has no direct Arrow equivalent and the sink has to infer it.
+    """
+    json_schema = model.model_json_schema()
+    row_type = _arrow_type(json_schema, json_schema.get("$defs", {}))
+    return pa.schema(list(row_type)) if row_type is not None else None
+
+
+def _promote_null_fields(schema):
+    """
+    Replaces the null type pyarrow infers for all-None columns with strings,
+    so a later batch with values in such a column can still be written.
+    """
+    return pa.schema(
+        field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+        for field in schema
+    )
+
+
+class StreamingParquetSink(_OutputSink):
+    """
+    Writes rows to ZSTD-compressed, dictionary-encoded Parquet as they arrive
+    (see _PARQUET_WRITE_OPTIONS).
+
+    Rows are buffered per column and flushed as one row group every
+    batch_size rows, so memory stays constant however many rows are written.
+    Callers should pass the output schema: every row group of a Parquet file
+    shares one schema, so without it the schema is inferred from the first
+    batch, with all-None columns promoted to strings.
+
+    Pages are content-defined chunked when pyarrow supports it, so re-pushing
+    a grown or regenerated output only uploads the pages that changed.
+    """
+
+    def __init__(self, output_file, schema=None, batch_size=8192):
+        super().__init__(output_file)
+        self.schema = schema
+        self.batch_size = batch_size
+        self._columns = None
+        self._buffered = 0
+        self._writer = None
+
+    def append(self, row):
+        if self._columns is None:
+            names = self.schema.names if self.schema is not None else list(row)
+            self._columns = {name: [] for name in names}
+        for name, values in self._columns.items():
+            values.append(row.get(name))
+        self._buffered += 1
+        self.count += 1
+        if self._buffered >= self.batch_size:
+            self._flush()
+
+    def append_batch(self, batch):
+        # Buffered rows go first to keep the rows in order.
+        self._flush()
+        self._write(batch)
+        self.count += batch.num_rows
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        # The column lists become Arrow arrays in one pass each, built with
+        # the schema's types directly when there is one.
+        self._write(pa.record_batch(self._columns, schema=self.schema))
+        for values in self._columns.values():
+            values.clear()
+        self._buffered = 0
+
+    def _write(self, batch):
+        if self._writer is None:
+            self.schema = self.schema or _promote_null_fields(batch.schema)
+            cdc_kwargs = {}
+            if _PARQUET_CDC_OPTIONS is not None:
+                cdc_kwargs["use_content_defined_chunking"] = _PARQUET_CDC_OPTIONS
+            self._writer = pq.ParquetWriter(
+                self.tmp_file,
+                self.schema,
+                write_page_index=True,
+                **_PARQUET_WRITE_OPTIONS,
+                **cdc_kwargs,
+            )
+            if _PARQUET_CDC_OPTIONS is not None:
+                self._writer.add_key_value_metadata(
+                    {"content_defined_chunking": json.dumps(_PARQUET_CDC_OPTIONS)}
+                )
+        if batch.schema != self.schema:
+            batch = batch.select(self.schema.names).cast(self.schema)
+        self._writer.write_batch(batch, row_group_size=self.batch_size)
+
+    def _finish(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+        else:
+            pq.write_table(
+                pa.table({}) if self.schema is None else self.schema.empty_table(),
+                self.tmp_file,
+                **_PARQUET_WRITE_OPTIONS,
+            )
+
+
+class JsonlSink(_OutputSink):
+    """Writes rows as JSON lines as they arrive."""
+
+    def __init__(self, output_file):
+        super().__init__(output_file)
+        self._file = open(self.tmp_file, "w", encoding="utf-8")
+
+    def append(self, row):
+        self._file.write(dumps_json(row) + "\n")
+        self.count += 1
+
+    def _finish(self):
+        self._file.close()
+
+
+def open_output_sink(output_file, schema=None):
+    """
+    Returns the sink matching the output file's extension. schema is the
+    pyarrow schema of the rows, used for Parquet outputs.
     """
-    new_dataset = Dataset.from_list(completions)
     extension = os.path.splitext(output_file)[1]
+    if extension == ".parquet":
+        return StreamingParquetSink(output_file, schema=schema)
+    elif extension == ".jsonl":
+        return JsonlSink(output_file)
+    handle_error(f"{extension} is not supported: please use .parquet or .jsonl")
+
+
+@functools.lru_cache(maxsize=None)
+def _get_hf_api(hf_api_token):
+    """Returns a shared HfApi client for the given token."""
+    return HfApi(token=hf_api_token)
+
+
+# The shard name push_to_hub() uses for a single-shard train split, so an
+# upload replaces what an earlier push_to_hub() of the dataset wrote.
+_HUB_PARQUET_PATH = "data/train-00000-of-00001.parquet"
+
+
+def _upload_parquet(api, output_file, hf_repo_id):
+    """
+    Uploads a Parquet output file to the Hub as-is, rather than re-encoding it
+    into new shards with push_to_hub(), so its content-defined chunking lets
+    Xet deduplicate the pages the Hub already has. Other train shards left by
+    an earlier push are deleted in the same commit.
+    """
+    api.create_repo(hf_repo_id, repo_type="dataset", exist_ok=True)
+    stale_shards = [
+        CommitOperationDelete(path_in_repo=path)
+        for path in api.list_repo_files(hf_repo_id, repo_type="dataset")
+        if path.startswith("data/train-") and path != _HUB_PARQUET_PATH
+    ]
+    api.create_commit(
+        hf_repo_id,
+        repo_type="dataset",
+        operations=[
+            CommitOperationAdd(
+                path_in_repo=_HUB_PARQUET_PATH, path_or_fileobj=output_file
+            ),
+            *stale_shards,
+        ],
+        commit_message="Upload dataset with completionist",
+    )
+
+
+def push_dataset_to_hub(output_file, hf_repo_id, hf_api_token):
+    """Pushes a saved output file to the Hugging Face Hub."""
+    print(f"Pushing dataset to Hugging Face Hub as '{hf_repo_id}'...")
     try:
-        if extension == ".parquet":
-            new_dataset.to_parquet(output_file)
-        elif extension == ".jsonl":
-            new_dataset.to_json(output_file)
-        else:
-            raise ValueError(
-                f"{extension} is not supported: please use .parquet or .jsonl"
+        api = _get_hf_api(hf_api_token)
+        try:
+            api.whoami()
+        except Exception:
+            print(
+                "You must be logged in or have the HUGGING_FACE_HUB_TOKEN environment variable set to push a dataset."
+            )
+            print(
+                "Please run `huggingface-cli login` or set the environment variable and try again."
             )
-        print(f"Generated dataset saved locally to {output_file}")
+            sys.exit(1)
+        if output_file.endswith(".parquet"):
+            _upload_parquet(api, output_file, hf_repo_id)
+        else:
+            Dataset.from_json(output_file).push_to_hub(hf_repo_id, token=api.token)
+        print("Successfully pushed dataset to the Hugging Face Hub!")
     except Exception as e:
-        handle_error(f"Error saving dataset locally: {e}")
+        handle_error(f"Error pushing dataset to the Hub: {e}")
 
-    if push_to_hub:
-        print(f"Pushing dataset to Hugging Face Hub as '{hf_repo_id}'...")
-        try:
-            api = HfApi(token=hf_api_token)
-            try:
-                api.whoami()
-            except Exception:
-                print(
-                    "You must be logged in or have the HUGGING_FACE_HUB_TOKEN environment variable set to push a dataset."
-                )
-                print(
-                    "Please run `huggingface-cli login` or set the environment variable and try again."
-                )
-                sys.exit(1)
-            new_dataset.push_to_hub(hf_repo_id)
-            print("Successfully pushed dataset to the Hugging Face Hub!")
-        except Exception as e:
-            handle_error(f"Error pushing dataset to the Hub: {e}")
+
+def write_output(
+    output_file,
+    existing_rows,
+    generate,
+    schema=None,
+    push_to_hub=False,
+    hf_repo_id=None,
+    hf_api_token=None,
+):
+    """
+    Writes a command's output file. The rows kept from a previous run are
+    streamed into a new output first, then generate(sink) appends the new
+    ones and returns how many it added. The file is only rewritten (and
+    pushed to the Hub, if requested) when that adds rows to the existing
+    output: new ones, or rows recovered from a checkpoint. Re-running a
+    finished job, or generate raising, leaves the output untouched.
+    """
+    sink = open_output_sink(output_file, schema=schema)
+    try:
+        sink.extend(existing_rows)
+        added = generate(sink)
+    except BaseException:
+        sink.discard()
+        raise
+    recovered = os.path.exists(get_checkpoint_file(output_file))
+    if sink.count > 0 and (added or recovered):
+        sink.close()
+        if push_to_hub:
+            push_dataset_to_hub(output_file, hf_repo_id, hf_api_token)
+    else:
+        sink.discard()
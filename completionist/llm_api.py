@@ -1,11 +1,393 @@
-import traceback
-from typing import Optional, Union, Dict
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import random
+import re
+import statistics
+import threading
+import time
+from typing import Optional, Union, Dict, List
 
 from pydantic import BaseModel
+import openai
 from openai import OpenAI as OpenAIClient
+from outlines import Generator as OutlinesGenerator
 from outlines import OpenAI as OutlinesOpenAI
 from outlines import inputs as outlines_inputs
 import httpx
+from tqdm import tqdm
+
+from completionist.utils import describe_exception, dumps_json, loads_json
+
+try:
+    import h2  # noqa: F401
+
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+# One connection pool shared by every worker thread, so keep-alive sockets are
+# reused across requests instead of paying a new TCP/TLS handshake per sample.
+# When the optional h2 package is installed, HTTPS endpoints that support it
+# are spoken to over HTTP/2, multiplexing requests over fewer connections.
+_HTTP_CLIENT: Optional[httpx.Client] = None
+_HTTP_CLIENT_LOCK = threading.Lock()
+_HTTP_KEEPALIVE_CONNECTIONS = 100
+# Set while the pool is closed. After a Ctrl-C the executor returns without
+# waiting for the requests in flight, so close_http_client() runs under them;
+# their failures are expected then and not reported.
+_HTTP_CLIENT_CLOSED = threading.Event()
+
+
+def configure_http_pool(concurrency: int):
+    """
+    Sizes the shared connection pool's keep-alive slots for `concurrency`
+    simultaneous requests (doubled to leave room for hedged duplicates), so
+    no worker has to reconnect because its socket was evicted. Only takes
+    effect before the first request creates the pool.
+    """
+    global _HTTP_KEEPALIVE_CONNECTIONS
+    _HTTP_KEEPALIVE_CONNECTIONS = max(2 * concurrency, 20)
+
+
+def _get_http_client() -> httpx.Client:
+    """Returns the process-wide httpx client, creating it on first use."""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None:
+        with _HTTP_CLIENT_LOCK:
+            if _HTTP_CLIENT is None:
+                _HTTP_CLIENT_CLOSED.clear()
+                _HTTP_CLIENT = httpx.Client(
+                    http2=_HTTP2,
+                    limits=httpx.Limits(
+                        max_connections=1000,
+                        max_keepalive_connections=_HTTP_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=90,
+                    ),
+                    event_hooks={"response": [_observe_rate_limit_headers]},
+                )
+    return _HTTP_CLIENT
+
+
+def close_http_client():
+    """
+    Closes the shared connection pool and the clients built on it, and drops
+    the memoized responses. Requests still in flight fail silently; a later
+    request creates a new pool.
+    """
+    global _HTTP_CLIENT
+    with _HTTP_CLIENT_LOCK:
+        _HTTP_CLIENT_CLOSED.set()
+        if _HTTP_CLIENT is not None:
+            _HTTP_CLIENT.close()
+            _HTTP_CLIENT = None
+    _get_openai_client.cache_clear()
+    _get_outlines_generator.cache_clear()
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_openai_client(api_url: str, api_key: str) -> OpenAIClient:
+    """
+    Returns an OpenAI client for the given endpoint, cached so every task
+    reuses the same client instead of rebuilding it per request.
+
+    The client retries 429 and 5xx responses with exponential backoff.
+    """
+    return OpenAIClient(
+        base_url=api_url,
+        api_key=api_key,
+        max_retries=3,
+        http_client=_get_http_client(),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_outlines_generator(client, model_name: str, pydantic_schema):
+    """
+    Returns an outlines generator bound to a client, model and output schema,
+    built once and shared by every task that uses the same combination.
+    """
+    return OutlinesGenerator(
+        OutlinesOpenAI(client=client, model_name=model_name), pydantic_schema
+    )
+
+
+# Errors after which a request is retried on another endpoint (connection
+# failures, timeouts and 5xx responses, once the client's own retries are spent).
+_FAILOVER_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+
+
+@functools.lru_cache(maxsize=None)
+def _split_api_urls(api_url: str) -> tuple:
+    """Splits a comma-separated --api-url value into individual endpoint URLs."""
+    urls = tuple(url.strip() for url in api_url.split(",") if url.strip())
+    if not urls:
+        raise ValueError("At least one API URL is required.")
+    return urls
+
+
+class _EndpointPool:
+    """
+    Spreads requests over several OpenAI-compatible endpoints.
+
+    Each request goes to the live endpoint with the fewest requests in flight.
+    An endpoint that fails is skipped for `cooldown` seconds; if every endpoint
+    is cooling down, the one that failed first is tried again.
+
+    The latencies of the last 256 successful requests per endpoint are kept to
+    decide when a slow request should be hedged on another endpoint.
+    """
+
+    def __init__(self, urls: tuple, cooldown: float = 30.0):
+        self.urls = urls
+        self.cooldown = cooldown
+        self._in_flight = {url: 0 for url in urls}
+        self._dead_until = {url: 0.0 for url in urls}
+        self._latencies = {url: collections.deque(maxlen=256) for url in urls}
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude=()) -> str:
+        with self._lock:
+            now = time.monotonic()
+            candidates = [url for url in self.urls if url not in exclude]
+            live = [url for url in candidates if self._dead_until[url] <= now]
+            if live:
+                url = min(live, key=lambda u: self._in_flight[u])
+            else:
+                url = min(candidates, key=lambda u: self._dead_until[u])
+            self._in_flight[url] += 1
+            return url
+
+    def release(self, url: str, failed: bool = False):
+        with self._lock:
+            self._in_flight[url] -= 1
+            if failed:
+                self._dead_until[url] = time.monotonic() + self.cooldown
+
+    def record_latency(self, url: str, seconds: float):
+        with self._lock:
+            self._latencies[url].append(seconds)
+
+    def hedge_delay(self, url: str) -> Optional[float]:
+        """
+        Returns how long to wait for a request to url before hedging it:
+        1.5x the endpoint's P95 latency. None when hedging is not possible
+        (a single endpoint) or too few requests have been observed.
+        """
+        if len(self.urls) < 2:
+            return None
+        with self._lock:
+            latencies = list(self._latencies[url])
+        if len(latencies) < 20:
+            return None
+        return 1.5 * statistics.quantiles(latencies, n=20)[-1]
+
+
+@functools.lru_cache(maxsize=None)
+def _get_endpoint_pool(urls: tuple) -> _EndpointPool:
+    return _EndpointPool(urls)
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket shared by every worker sending to one endpoint.
+
+    Each request takes one token; tokens refill at `rate` per second up to
+    `burst`. With rate=None requests are not throttled, but the bucket can
+    still be paused, so a 429 makes every worker hold off for the Retry-After
+    period together instead of each backing off (and retrying) on its own.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate or 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self._tokens = min(
+                        self.burst, self._tokens + (now - self._updated) * self.rate
+                    )
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Holds back every request on this bucket for the next `seconds`."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+# One bucket per endpoint URL, so the response hook below can find the bucket
+# for the endpoint that answered.
+_BUCKETS: Dict[str, TokenBucket] = {}
+_BUCKETS_LOCK = threading.Lock()
+
+
+def _get_token_bucket(url: str, max_rps: Optional[float]) -> TokenBucket:
+    with _BUCKETS_LOCK:
+        bucket = _BUCKETS.get(url)
+        if bucket is None:
+            bucket = _BUCKETS[url] = TokenBucket(max_rps)
+        return bucket
+
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def _parse_reset(value: str) -> Optional[float]:
+    """Parses an x-ratelimit-reset-* value such as '1s', '6m0s' or '250ms'."""
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def _observe_rate_limit_headers(response: httpx.Response):
+    """
+    httpx response hook that pauses an endpoint's bucket before the server
+    starts rejecting requests: when x-ratelimit-remaining-requests or
+    -tokens reaches zero, every worker waits for the matching reset period.
+    A 429 pauses the bucket right away for its Retry-After period, while the
+    client is still retrying it.
+    """
+    headers = response.headers
+    pause = 0.0
+    if response.status_code == 429:
+        pause = _retry_after(response, default=1.0)
+    for kind in ("requests", "tokens"):
+        remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+        reset = headers.get(f"x-ratelimit-reset-{kind}")
+        if remaining is None or reset is None:
+            continue
+        try:
+            exhausted = float(remaining) <= 0
+        except ValueError:
+            continue
+        if exhausted:
+            pause = max(pause, _parse_reset(reset) or 0.0)
+    if not pause:
+        return
+    request_url = str(response.request.url)
+    with _BUCKETS_LOCK:
+        buckets = [b for url, b in _BUCKETS.items() if request_url.startswith(url)]
+    for bucket in buckets:
+        bucket.pause(pause)
+
+
+# How often a request that keeps getting 429s is retried after the client's
+# own retries are spent, pausing the endpoint's bucket each time.
+_RATE_LIMIT_RETRIES = 3
+
+
+def _retry_after(response: httpx.Response, default: float) -> float:
+    """Returns the server-requested delay of a 429 response, in seconds."""
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After may also be an HTTP date; fall back to our own backoff.
+        pass
+    return default
+
+
+# Completions for deterministic (temperature == 0) or explicitly memoized
+# requests, keyed by every parameter that affects the output. Finished results
+# are kept in a bounded LRU so long runs stay in constant memory; requests
+# still in flight are tracked as Futures so concurrent identical requests wait
+# for the one already running instead of racing it.
+_RESPONSE_CACHE_SIZE = 4096
+_RESPONSE_CACHE = collections.OrderedDict()
+_INFLIGHT_REQUESTS: Dict[tuple, concurrent.futures.Future] = {}
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+
+def _memoized(key: tuple, compute):
+    """Returns the cached result for key, computing it once if needed."""
+    with _RESPONSE_CACHE_LOCK:
+        if key in _RESPONSE_CACHE:
+            _RESPONSE_CACHE.move_to_end(key)
+            result = _RESPONSE_CACHE[key]
+            return dict(result) if isinstance(result, dict) else result
+        future = _INFLIGHT_REQUESTS.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = concurrent.futures.Future()
+            _INFLIGHT_REQUESTS[key] = future
+    if not is_owner:
+        result = future.result()
+    else:
+        try:
+            result = compute()
+        except BaseException as e:
+            with _RESPONSE_CACHE_LOCK:
+                _INFLIGHT_REQUESTS.pop(key, None)
+            future.set_exception(e)
+            raise
+        with _RESPONSE_CACHE_LOCK:
+            _INFLIGHT_REQUESTS.pop(key, None)
+            # Failed requests are not cached, so a later call can retry.
+            if result is not None:
+                _RESPONSE_CACHE[key] = result
+                if len(_RESPONSE_CACHE) > _RESPONSE_CACHE_SIZE:
+                    _RESPONSE_CACHE.popitem(last=False)
+        future.set_result(result)
+    # Callers get their own copy of plain dict results.
+    return dict(result) if isinstance(result, dict) else result
+
+
+_HF_HOSTS = ("huggingface.cloud", "api-inference.huggingface.co")
+
+
+@functools.lru_cache(maxsize=None)
+def _is_hf_url(api_url: str) -> bool:
+    """Whether api_url is a Hugging Face endpoint, scanned once per URL."""
+    return any(host in api_url for host in _HF_HOSTS)
+
+
+def _resolve_api_token(
+    api_url: str, hf_api_token: Optional[str], openai_api_token: Optional[str]
+) -> Optional[str]:
+    """Picks the Hugging Face token for HF endpoints, the OpenAI token otherwise."""
+    if _is_hf_url(api_url):
+        if not hf_api_token:
+            raise TypeError(
+                "An hugging face token is required to perform this request."
+            )
+        return hf_api_token
+    return openai_api_token
+
+
+def _build_messages(prompt: str, system_prompt: Optional[str]) -> List[Dict[str, str]]:
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
 
 
 def get_completion(
@@ -21,6 +403,10 @@ def get_completion(
     pydantic_schema: Optional[BaseModel] = None,
     reasoning_effort: Optional[str] = None,
     reasoning: Optional[str] = None,
+    stream_validate: bool = False,
+    max_rps: Optional[float] = None,
+    max_reasoning_tokens: Optional[int] = None,
+    memoize: bool = False,
 ) -> Union[Dict[str, Optional[str]], BaseModel]:
     """
     Sends a prompt to an LLM API to get a completion.
@@ -29,88 +415,618 @@ def get_completion(
     structured, schema-enforced generation via the native generate() API.
     Otherwise, it performs a standard text completion request.
 
+    Deterministic requests (temperature == 0) are memoized in a bounded LRU
+    of the most recent _RESPONSE_CACHE_SIZE results, so repeated identical
+    prompts that are close together cost a single API call.
+
     Args:
         prompt: The text prompt to send.
         model_name: The name of the model to use for generation.
-        api_url: The URL of the API endpoint.
+        api_url: The URL of the API endpoint, or several comma-separated URLs
+            to load-balance across, failing over on connection errors and 5xx.
         system_prompt: An optional system prompt.
         hf_api_token: An optional Hugging Face API token.
         max_tokens: The maximum number of tokens to generate.
         temperature: The sampling temperature.
         top_p: The nucleus sampling probability.
         pydantic_schema: An optional Pydantic BaseModel to enforce structured output.
+        stream_validate: With a schema, stream the response and abort it as
+            soon as the JSON is structurally invalid, instead of paying for
+            the remaining tokens of a sample that cannot validate.
+        max_rps: An optional cap on requests per second, per endpoint, shared
+            by all threads. Rate-limited (429) requests pause the endpoint for
+            the Retry-After period either way.
+        max_reasoning_tokens: Without a schema, stream the response and abort
+            it once the model has spent this many tokens reasoning, instead of
+            paying for a runaway <think> block.
+        memoize: Memoize the request even when sampling (temperature > 0),
+            so identical prompts share one completion.
 
     Returns:
         If a schema is provided, returns a Pydantic object.
         Otherwise, returns a dict with 'content' and 'reasoning_content' keys.
     """
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.append({"role": "user", "content": prompt})
+    request = dict(
+        prompt=prompt,
+        model_name=model_name,
+        api_url=api_url,
+        system_prompt=system_prompt,
+        hf_api_token=hf_api_token,
+        openai_api_token=openai_api_token,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        top_p=top_p,
+        pydantic_schema=pydantic_schema,
+        reasoning_effort=reasoning_effort,
+        reasoning=reasoning,
+        stream_validate=stream_validate,
+        max_rps=max_rps,
+        max_reasoning_tokens=max_reasoning_tokens,
+    )
+    if temperature == 0 or memoize:
+        return _memoized(_request_key(request), lambda: _request_completion(**request))
+    return _request_completion(**request)
+
 
-    api_token = openai_api_token
-    is_hf_url = (
-        "huggingface.cloud" in api_url or "api-inference.huggingface.co" in api_url
+def _request_key(request: dict) -> tuple:
+    """
+    Returns the cache key of a request. The prompts are reduced to a 16-byte
+    blake2b digest, so the cache does not keep every prompt text alive.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for field in ("prompt", "system_prompt"):
+        digest.update((request[field] or "").encode("utf-8"))
+        digest.update(b"\0")
+    params = tuple(
+        item for item in request.items() if item[0] not in ("prompt", "system_prompt")
     )
-    if is_hf_url:
-        if not hf_api_token:
-            raise TypeError(
-                "An hugging face token is required to perform this request."
-            )
-        else:
-            api_token = hf_api_token
+    return (digest.digest(),) + params
 
+
+def _request_completion(
+    prompt,
+    model_name,
+    api_url,
+    system_prompt,
+    hf_api_token,
+    openai_api_token,
+    max_rps,
+    **generation,
+):
+    messages = _build_messages(prompt, system_prompt)
+    # A bad --api-url or a missing token is not a per-request failure, so it
+    # is raised here instead of being reported (and skipped) for every sample.
+    endpoints = _resolve_endpoints(api_url, hf_api_token, openai_api_token)
     try:
+        return _send(
+            endpoints,
+            max_rps,
+            lambda client: _call_endpoint(client, messages, model_name, **generation),
+        )
+    except Exception as e:
+        if not _HTTP_CLIENT_CLOSED.is_set():
+            tqdm.write(
+                f"Error during structured generation for prompt: '{prompt[:50]}...': {describe_exception(e)}"
+            )
+        return None
+
+
+def _resolve_endpoints(api_url, hf_api_token, openai_api_token):
+    """
+    Returns the endpoint pool for api_url and the API token of each of its
+    endpoints. Raises if api_url has no URL or an HF endpoint has no token.
+    """
+    pool = _get_endpoint_pool(_split_api_urls(api_url))
+    api_tokens = {
+        url: _resolve_api_token(url, hf_api_token, openai_api_token)
+        for url in pool.urls
+    }
+    return pool, api_tokens
+
+
+def _send(endpoints, max_rps, request):
+    """
+    Runs request(client) against one of the endpoints returned by
+    _resolve_endpoints(), going through the endpoint's token bucket and
+    failing over (or hedging) to the other endpoints. Raises the last error
+    if every endpoint failed.
+    """
+    pool, api_tokens = endpoints
+
+    def call(url):
         # For outlines, the client needs the base URL, not the full endpoint
-        client = OpenAIClient(
-            base_url=api_url,
-            api_key=api_token or "dummy",
-            http_client=httpx.Client(
-                limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100)
-            ),
+        client = _get_openai_client(url, api_tokens[url] or "dummy")
+        bucket = _get_token_bucket(url, max_rps)
+        for attempt in range(_RATE_LIMIT_RETRIES + 1):
+            bucket.acquire()
+            try:
+                return request(client)
+            except openai.RateLimitError as e:
+                if attempt == _RATE_LIMIT_RETRIES:
+                    raise
+                # Jitter keeps workers that hit the limit together from
+                # retrying in lockstep.
+                backoff = 2.0**attempt + random.uniform(0, 1)
+                bucket.pause(_retry_after(e.response, default=backoff))
+
+    tried = set()
+    while True:
+        url = pool.acquire(exclude=tried)
+        delay = pool.hedge_delay(url)
+        try:
+            if delay is None:
+                return _timed_call(pool, url, call)
+            return _hedged_call(pool, url, delay, call)
+        except _FAILOVER_ERRORS:
+            tried.add(url)
+            if len(tried) == len(pool.urls):
+                raise
+            tqdm.write(f"Warning: Endpoint {url} failed, retrying on another one.")
+
+
+def get_text_completions(
+    prompts: List[str],
+    model_name: str,
+    api_url: str,
+    hf_api_token: Optional[str] = None,
+    openai_api_token: Optional[str] = None,
+    max_tokens: int = 2048,
+    temperature: float = 0.7,
+    top_p: float = 0.95,
+    max_rps: Optional[float] = None,
+) -> List[Optional[Dict[str, Optional[str]]]]:
+    """
+    Sends several prompts in a single request to the (non-chat) completions
+    endpoint, which OpenAI-compatible servers such as vLLM accept as a list
+    and schedule together.
+
+    The prompts are sent as-is: this endpoint has no chat template and no
+    system prompt.
+
+    Returns:
+        A list aligned with prompts of dicts with 'content' and
+        'reasoning_content' keys, or all None if the request failed.
+    """
+
+    def request(client):
+        response = client.completions.create(
+            model=model_name,
+            prompt=list(prompts),
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+        )
+        results = [None] * len(prompts)
+        for choice in response.choices:
+            results[choice.index] = _completion_result(choice.text, None)
+        return results
+
+    endpoints = _resolve_endpoints(api_url, hf_api_token, openai_api_token)
+    try:
+        return _send(endpoints, max_rps, request)
+    except Exception as e:
+        if not _HTTP_CLIENT_CLOSED.is_set():
+            tqdm.write(
+                f"Error during batched completion of {len(prompts)} prompts: {describe_exception(e)}"
+            )
+        return [None] * len(prompts)
+
+
+def _timed_call(pool, url, call):
+    """
+    Runs call(url) on an endpoint already acquired from the pool, records its
+    latency on success and releases the endpoint afterwards.
+    """
+    start = time.monotonic()
+    failed = False
+    try:
+        result = call(url)
+        pool.record_latency(url, time.monotonic() - start)
+        return result
+    except _FAILOVER_ERRORS:
+        failed = True
+        raise
+    finally:
+        pool.release(url, failed=failed)
+
+
+def _in_thread(fn, *args) -> concurrent.futures.Future:
+    """Runs fn(*args) on a new daemon thread and returns a Future for its result."""
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def _hedged_call(pool, url, delay, call):
+    """
+    Runs call(url), and if it has not finished after `delay` seconds sends a
+    duplicate request to another endpoint; the first successful result wins.
+
+    A blocking HTTP request cannot be aborted mid-flight, so the slower one is
+    left to finish in the background and its result is discarded. If both
+    fail, the original request's error is raised.
+    """
+    primary = _in_thread(_timed_call, pool, url, call)
+    done, _ = concurrent.futures.wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+    hedge_url = pool.acquire(exclude=(url,))
+    pending = {primary, _in_thread(_timed_call, pool, hedge_url, call)}
+    while pending:
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
         )
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+    return primary.result()
+
 
-        if pydantic_schema:
-            generator = OutlinesOpenAI(client=client, model_name=model_name)
-            chat_prompt = outlines_inputs.Chat(messages)
-            generate_kwargs = {}
-            if reasoning_effort is not None:
-                generate_kwargs["reasoning_effort"] = reasoning_effort
-            if reasoning is not None:
-                generate_kwargs["extra_body"] = {"reasoning": reasoning}
-            return generator.generate(
+def _call_endpoint(
+    client,
+    messages,
+    model_name,
+    max_tokens,
+    temperature,
+    top_p,
+    pydantic_schema,
+    reasoning_effort,
+    reasoning,
+    stream_validate,
+    max_reasoning_tokens,
+):
+    if pydantic_schema and not stream_validate:
+        generator = _get_outlines_generator(client, model_name, pydantic_schema)
+        chat_prompt = outlines_inputs.Chat(messages)
+        generate_kwargs = {}
+        if reasoning_effort is not None:
+            generate_kwargs["reasoning_effort"] = reasoning_effort
+        if reasoning is not None:
+            generate_kwargs["extra_body"] = {"reasoning": reasoning}
+        return _parse_structured(
+            generator(
                 chat_prompt,
-                output_type=pydantic_schema,
                 temperature=temperature,
                 top_p=top_p,
                 max_tokens=max_tokens,
                 **generate_kwargs,
-            )
-        else:
-            extra_kwargs = {}
-            extra_body = {}
-            if reasoning_effort is not None:
-                extra_kwargs["reasoning_effort"] = reasoning_effort
-            if reasoning is not None:
-                extra_body["reasoning"] = reasoning
-            result = client.chat.completions.create(
+            ),
+            pydantic_schema,
+        )
+
+    extra_kwargs = {}
+    extra_body = {}
+    if reasoning_effort is not None:
+        extra_kwargs["reasoning_effort"] = reasoning_effort
+    if reasoning is not None:
+        extra_body["reasoning"] = reasoning
+    if pydantic_schema:
+        return _stream_structured(
+            client.chat.completions.create(
                 model=model_name,
                 messages=messages,
                 temperature=temperature,
                 top_p=top_p,
                 max_tokens=max_tokens,
+                response_format=_json_schema_response_format(pydantic_schema),
+                stream=True,
                 extra_body=extra_body if extra_body else None,
                 **extra_kwargs,
-            )
-            return {
-                "content": result.choices[0].message.content,
-                "reasoning_content": getattr(
-                    result.choices[0].message, "reasoning_content", None
-                ),
-            }
-    except Exception:
-        print(
-            f"Error during structured generation for prompt: '{prompt[:50]}...': {traceback.format_exc()}"
+            ),
+            pydantic_schema,
         )
-        return None
+    if max_reasoning_tokens:
+        return _stream_completion(
+            client.chat.completions.create(
+                model=model_name,
+                messages=messages,
+                temperature=temperature,
+                top_p=top_p,
+                max_tokens=max_tokens,
+                stream=True,
+                extra_body=extra_body if extra_body else None,
+                **extra_kwargs,
+            ),
+            max_reasoning_tokens,
+        )
+    result = client.chat.completions.create(
+        model=model_name,
+        messages=messages,
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_tokens,
+        extra_body=extra_body if extra_body else None,
+        **extra_kwargs,
+    )
+    return _completion_result(
+        result.choices[0].message.content,
+        getattr(result.choices[0].message, "reasoning_content", None),
+    )
+
+
+# Markdown code fences some models wrap their JSON output in.
+_JSON_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+
+def _parse_structured(output, pydantic_schema: BaseModel) -> BaseModel:
+    """
+    Validates outlines' output against the schema. The OpenAI backend returns
+    the raw JSON text, which is parsed and validated in a single pass by
+    pydantic-core after stripping any Markdown code fence.
+    """
+    if isinstance(output, pydantic_schema):
+        return output
+    return pydantic_schema.model_validate_json(_JSON_FENCE_RE.sub("", output))
+
+
+_THINK_RE = re.compile(r"<think>(.*?)</think>", re.DOTALL)
+
+
+def _split_reasoning(text: str):
+    """
+    Splits inline <think>...</think> blocks out of a completion in a single
+    pass. Returns the cleaned completion and the joined reasoning text.
+    """
+    # Most completions have no inline reasoning; a substring search is much
+    # cheaper than running the regex over a long answer.
+    if "<think>" not in text:
+        return text, ""
+    parts = []
+    reasoning_parts = []
+    pos = 0
+    for match in _THINK_RE.finditer(text):
+        parts.append(text[pos : match.start()])
+        reasoning_parts.append(match.group(1))
+        pos = match.end()
+    if not reasoning_parts:
+        return text, ""
+    parts.append(text[pos:])
+    return "".join(parts).strip(), "\n".join(reasoning_parts).strip()
+
+
+def _completion_result(
+    content: Optional[str], reasoning_content: Optional[str]
+) -> Dict[str, Optional[str]]:
+    """
+    Builds the dict returned for a text completion. Some servers inline the
+    reasoning in the content instead of returning it in a separate
+    reasoning_content field; it is split out here so every command gets the
+    answer without the <think> block.
+    """
+    if not reasoning_content and content:
+        content, reasoning_content = _split_reasoning(content)
+    return {"content": content, "reasoning_content": reasoning_content}
+
+
+def _json_schema_response_format(pydantic_schema: BaseModel) -> dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": pydantic_schema.__name__,
+            "schema": pydantic_schema.model_json_schema(),
+        },
+    }
+
+
+class _JsonPrefixValidator:
+    """
+    Incrementally checks that streamed text can still become one JSON object.
+
+    Only structure is tracked (brackets, strings, trailing data), which is
+    enough to catch a generation that has gone off the rails long before
+    the model stops on its own.
+    """
+
+    _CLOSERS = {"}": "{", "]": "["}
+
+    def __init__(self):
+        self._stack = []
+        self._started = False
+        self._in_string = False
+        self._escaped = False
+        self.complete = False
+
+    def feed(self, text: str):
+        for char in text:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char.isspace():
+                continue
+            elif self.complete:
+                raise ValueError(f"Unexpected {char!r} after the end of the object.")
+            elif not self._started:
+                if char != "{":
+                    raise ValueError(f"Expected a JSON object, got {char!r}.")
+                self._started = True
+                self._stack.append(char)
+            elif char in "{[":
+                self._stack.append(char)
+            elif char in self._CLOSERS:
+                if self._stack.pop() != self._CLOSERS[char]:
+                    raise ValueError(f"Mismatched {char!r} in JSON output.")
+                self.complete = not self._stack
+            elif char == '"':
+                self._in_string = True
+
+
+def _stream_structured(stream, pydantic_schema: BaseModel) -> BaseModel:
+    """
+    Consumes a streamed structured response, closing the stream (and so the
+    server-side generation) the moment the output stops being valid JSON.
+    """
+    validator = _JsonPrefixValidator()
+    parts = []
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                validator.feed(delta)
+                parts.append(delta)
+    except ValueError as e:
+        stream.close()
+        raise ValueError(f"Aborted invalid structured generation: {e}") from e
+    return pydantic_schema.model_validate_json("".join(parts))
+
+
+def _stream_completion(stream, max_reasoning_tokens: int) -> Dict[str, Optional[str]]:
+    """
+    Consumes a streamed text completion, closing the stream (and so the
+    server-side generation) once the reasoning runs past max_reasoning_tokens
+    without reaching an answer. Each streamed chunk counts as one token.
+
+    Reasoning is recognised both in a separate reasoning_content/reasoning
+    delta field and inline between <think> and </think> in the content.
+    """
+    parts = []
+    reasoning_parts = []
+    reasoning_tokens = 0
+    thinking = False
+    tail = ""
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        reasoning_delta = getattr(delta, "reasoning_content", None) or getattr(
+            delta, "reasoning", None
+        )
+        if reasoning_delta:
+            reasoning_parts.append(reasoning_delta)
+            reasoning_tokens += 1
+        if delta.content:
+            parts.append(delta.content)
+            # Tags can be split across chunks, so look at the end of the
+            # previous chunk too.
+            window = tail + delta.content
+            opened, closed = window.rfind("<think>"), window.rfind("</think>")
+            if opened != closed:
+                thinking = opened > closed
+            tail = window[-8:]
+            if thinking:
+                reasoning_tokens += 1
+        if reasoning_tokens > max_reasoning_tokens:
+            stream.close()
+            raise ValueError(
+                f"Aborted generation: reasoning exceeded {max_reasoning_tokens} tokens."
+            )
+    return _completion_result("".join(parts), "".join(reasoning_parts) or None)
+
+
+_BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def get_batch_completions(
+    prompts: List[str],
+    model_name: str,
+    api_url: str,
+    pydantic_schema: BaseModel,
+    system_prompt: Optional[str] = None,
+    hf_api_token: Optional[str] = None,
+    openai_api_token: Optional[str] = None,
+    max_tokens: int = 2048,
+    temperature: float = 0.7,
+    top_p: float = 0.95,
+    max_poll_interval: float = 60.0,
+) -> List[Optional[BaseModel]]:
+    """
+    Generates structured completions for many prompts through the Batch API.
+
+    All prompts are written to a single JSONL file, uploaded, and submitted as
+    one batch job against /v1/chat/completions. The job is polled with
+    exponential backoff until it reaches a terminal state.
+
+    Args:
+        prompts: The user prompts to send, one request per prompt.
+        model_name: The name of the model to use for generation.
+        api_url: The URL of the API endpoint.
+        pydantic_schema: The Pydantic BaseModel each response must match.
+        system_prompt: An optional system prompt.
+        hf_api_token: An optional Hugging Face API token.
+        openai_api_token: An optional OpenAI API token.
+        max_tokens: The maximum number of tokens to generate.
+        temperature: The sampling temperature.
+        top_p: The nucleus sampling probability.
+        max_poll_interval: Upper bound, in seconds, for the polling backoff.
+
+    Returns:
+        A list aligned with prompts, holding a Pydantic object for every
+        request that succeeded and None for the ones that failed.
+    """
+    # A batch job lives on a single server, so only the first endpoint is used.
+    api_url = _split_api_urls(api_url)[0]
+    api_token = _resolve_api_token(api_url, hf_api_token, openai_api_token)
+    client = _get_openai_client(api_url, api_token or "dummy")
+
+    response_format = _json_schema_response_format(pydantic_schema)
+    lines = []
+    for i, prompt in enumerate(prompts):
+        request = {
+            "custom_id": f"t{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model_name,
+                "messages": _build_messages(prompt, system_prompt),
+                "temperature": temperature,
+                "top_p": top_p,
+                "max_tokens": max_tokens,
+                "response_format": response_format,
+            },
+        }
+        lines.append(dumps_json(request))
+    batch_input = ("\n".join(lines) + "\n").encode("utf-8")
+
+    input_file = client.files.create(
+        file=("batch_input.jsonl", batch_input), purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    print(f"Submitted batch {batch.id} with {len(prompts)} requests.")
+
+    poll_interval = 1.0
+    while batch.status not in _BATCH_TERMINAL_STATUSES:
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, max_poll_interval)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} finished with status '{batch.status}'.")
+
+    results: List[Optional[BaseModel]] = [None] * len(prompts)
+    output = client.files.content(batch.output_file_id).content
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        record = loads_json(line)
+        idx = int(record["custom_id"][1:])
+        response = record.get("response") or {}
+        if response.get("status_code") != 200:
+            print(
+                f"Warning: Batch request {record['custom_id']} failed: "
+                f"{record.get('error') or response.get('body')}"
+            )
+            continue
+        try:
+            content = response["body"]["choices"][0]["message"]["content"]
+            results[idx] = pydantic_schema.model_validate_json(content)
+        except Exception as e:
+            print(
+                f"Warning: Batch request {record['custom_id']} returned an invalid sample: {e}"
+            )
+    return results
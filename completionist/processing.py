@@ -1,60 +1,196 @@
 import concurrent.futures
+import itertools
+import statistics
+import time
+from typing import Any, Optional, Protocol
 from tqdm import tqdm
 
+from completionist.dataset_io import open_checkpoint
+from completionist.llm_api import configure_http_pool
+from completionist.utils import dumps_json
+
+
+class TaskHandler(Protocol):
+    """
+    The per-task callable each command hands to the executor. It runs on a
+    worker thread and returns the output row for a sample (or a list of rows
+    with batch_size), or None when the sample failed.
+    """
+
+    def __call__(self, sample: Any, llm_config: dict) -> Optional[Any]: ...
+
+
+def iter_samples(dataset_to_process, column=None, batch_size=1024):
+    """
+    Yields the samples of a dataset as dicts, or just the values of one
+    column if given. Datasets are decoded a batch of rows at a time instead of
+    converting every row from Arrow individually; plain iterables such as
+    lists of topics are yielded as they are.
+    """
+    if not hasattr(dataset_to_process, "iter"):
+        yield from dataset_to_process
+        return
+    for batch in dataset_to_process.iter(batch_size=batch_size):
+        if column is not None:
+            yield from batch[column]
+            continue
+        columns = list(batch)
+        for values in zip(*batch.values()):
+            yield dict(zip(columns, values))
+
+
+class AdaptiveConcurrency:
+    """
+    Adjusts how many tasks may run at once from the latency observed per task.
+
+    Latencies are collected in windows of `limit` completed tasks (at least 8).
+    When a window's median latency stays within 10% of the previous window's,
+    the backend is keeping up and the limit grows by one; when it is more than
+    25% higher, requests are queueing server-side and the limit shrinks by two.
+    The limit always stays between minimum and maximum.
+    """
+
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = minimum
+        self._window = []
+        self._previous_median = None
+
+    def record(self, latency):
+        """Records the latency of one completed task, adjusting the limit per window."""
+        self._window.append(latency)
+        if len(self._window) < max(self.limit, 8):
+            return
+        median = statistics.median(self._window)
+        self._window = []
+        previous, self._previous_median = self._previous_median, median
+        if previous is None:
+            return
+        if median <= previous * 1.10:
+            self.limit = min(self.limit + 1, self.maximum)
+        elif median > previous * 1.25:
+            self.limit = max(self.limit - 2, self.minimum)
+
+
+def _timed(task_handler, sample, llm_config):
+    """Runs a task and returns its result together with its wall-clock latency."""
+    start = time.monotonic()
+    result = task_handler(sample, llm_config)
+    return result, time.monotonic() - start
+
 
 def process_samples_with_executor(
     dataset_to_process,
     workers,
     resume_idx,
-    task_handler,
+    task_handler: TaskHandler,
     llm_config,
-    save_callback=None,
-    save_every=50,
+    sink,
+    checkpoint_file=None,
+    max_inflight=None,
+    max_workers=None,
+    batch_size=None,
+    column=None,
 ):
     """
     Manages the concurrent execution of tasks using a ThreadPoolExecutor.
 
-    If save_callback is provided, it is called every save_every completions
-    with the current completions list so partial results can be persisted.
+    Each result is handed to sink.append() as soon as it arrives rather than
+    being collected in memory; the number of results is returned.
+
+    Samples are pulled from dataset_to_process lazily and at most max_inflight
+    tasks (default: twice the number of workers) are queued at any time; a new
+    sample is only submitted once a running task finishes. This keeps memory
+    bounded for large or streaming datasets and means an interrupt only
+    discards the few tasks that were actually in flight.
+
+    If checkpoint_file is provided, every result is appended to it as a JSON
+    line as soon as it arrives, so an interrupted or crashed run can resume
+    from the rows already generated.
 
-    On KeyboardInterrupt, pending futures are cancelled immediately and
-    partial progress is saved — no hang waiting for in-flight requests.
+    If max_workers is greater than workers, concurrency is adapted at runtime:
+    it starts at workers and moves between workers and max_workers based on
+    the observed task latency (see AdaptiveConcurrency). Tasks are then not
+    queued beyond the current limit, so queueing does not skew the latency.
+
+    With column, each task receives that column's value instead of the whole
+    sample as a dict.
+
+    With batch_size, consecutive samples are grouped into lists of up to
+    batch_size and each list is one task; the handler then returns a list
+    with one result (or None) per sample.
+
+    On KeyboardInterrupt, pending futures are cancelled immediately — no hang
+    waiting for in-flight requests.
     """
-    completions = []
-    futures = []
-    saved_count = 0
+    completed = 0
+    pending = set()
+    samples = iter_samples(dataset_to_process, column=column)
+    if batch_size:
+        rows = samples
+        samples = iter(lambda: list(itertools.islice(rows, batch_size)), [])
+    max_inflight = max_inflight or workers * 2
+    adaptive = None
+    if max_workers and max_workers > workers:
+        adaptive = AdaptiveConcurrency(workers, max_workers)
+    try:
+        total = resume_idx + len(dataset_to_process)
+    except TypeError:
+        # Streaming datasets have no known length.
+        total = None
+    # Results are collected on this thread only, so writes need no locking.
+    # The checkpoint is opened on the first result to avoid leaving empty files.
+    checkpoint = None
+
+    pool_size = adaptive.maximum if adaptive else workers
+    configure_http_pool(pool_size)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size)
+    # Refreshing at most twice a second keeps the bar cheap at high --workers.
+    progress = tqdm(
+        total=total,
+        initial=resume_idx,
+        desc="Generating completions",
+        mininterval=0.5,
+    )
+
+    def submit_more():
+        limit = adaptive.limit if adaptive else max_inflight
+        for sample in itertools.islice(samples, max(limit - len(pending), 0)):
+            pending.add(executor.submit(_timed, task_handler, sample, llm_config))
 
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
     try:
-        # Submit all tasks to the executor
-        for sample in dataset_to_process:
-            future = executor.submit(
-                task_handler,
-                sample,
-                llm_config,
+        submit_more()
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
             )
-            futures.append(future)
-
-        for future in tqdm(
-            concurrent.futures.as_completed(futures),
-            total=len(futures),
-            initial=resume_idx,
-            desc="Generating completions",
-        ):
-            result = future.result()
-            if result:
-                completions.append(result)
-
-            if save_callback and len(completions) - saved_count >= save_every:
-                save_callback(completions)
-                saved_count = len(completions)
+            for future in done:
+                pending.remove(future)
+                result, latency = future.result()
+                if adaptive:
+                    adaptive.record(latency)
+                results = result if batch_size else [result]
+                for result in results:
+                    if not result:
+                        continue
+                    sink.append(result)
+                    completed += 1
+                    if checkpoint_file and checkpoint is None:
+                        checkpoint = open_checkpoint(checkpoint_file)
+                    if checkpoint:
+                        checkpoint.write(dumps_json(result) + "\n")
+                progress.update(len(results))
+            submit_more()
 
     except KeyboardInterrupt:
-        print("\nProcess interrupted. Saving partial progress before exit...")
-        if save_callback and completions:
-            save_callback(completions)
+        tqdm.write("Process interrupted. Saving partial progress before exit...")
         executor.shutdown(wait=False, cancel_futures=True)
-        return completions
+        return completed
+    finally:
+        progress.close()
+        if checkpoint:
+            checkpoint.close()
 
     executor.shutdown(wait=True)
-    return completions
+    return completed
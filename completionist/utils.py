@@ -1,6 +1,34 @@
+import json
 import sys
+import traceback
 import click
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Set by the CLI's --debug flag; see describe_exception().
+_debug = False
+
+
+def set_debug(enabled):
+    """Enables full tracebacks in the warnings printed for failed tasks."""
+    global _debug
+    _debug = enabled
+
+
+def describe_exception(exc):
+    """
+    Formats an exception caught on a worker thread for a warning message.
+    Under load every transient failure lands here, so only the type and
+    message are shown unless --debug asks for the full traceback.
+    Must be called from the except block handling exc.
+    """
+    if _debug:
+        return traceback.format_exc()
+    return f"{type(exc).__name__}: {exc}"
+
 
 def handle_error(message):
     """Prints an error message and exits the program."""
@@ -17,3 +45,20 @@ def read_file_content(file_path):
             return f.read()
     except Exception as e:
         handle_error(f"Error reading file {file_path}: {e}")
+
+
+def dumps_json(obj):
+    """Serializes obj to a JSON string, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def loads_json(data):
+    """
+    Parses a JSON string or bytes, using orjson when it is installed.
+    Raises json.JSONDecodeError on invalid input either way.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)